@@ -1,62 +1,51 @@
 #!python3
 
+import atexit
 import logging
+import os
 import pprint
-import struct
+import re
 import sys
 
 
-class FixedSizeStack(bytearray):
-    def __init__(self, capacity: int):
-        self.capacity = capacity
-        super().__init__(0)
+def format_stack(s: bytearray, sp: int, depth: int = 0x100) -> str:
+    # Only the top `depth` bytes are shown, after a count of the hidden ones
+    start = max(sp - depth, 0)
+    items = [f"#{i:02x}" for i in s[start:sp]]
+    if start:
+        items.insert(0, f"(+{start})")
+    return f"[{', '.join(items)}]"
 
-    def push(self, b: int):
-        assert len(self) < self.capacity
-        super().append(b)
-
-    def __repr__(self) -> str:
-        return f"[{', '.join(f'#{i:02x}' for i in self)}]"
-
-    def __str__(self) -> str:
-        return repr(self)
+BLANK_MEMORY = bytes(0x10_000)
+BLANK_DEVICE = bytes(0x100)
 
 class Uxn:
     RESET = 0x100
+    __slots__ = ("pc", "mem", "code", "blocks", "heat", "dev", "ws", "wsp", "rs", "rsp")
 
     def __init__(self) -> None:
-        self.pc = 0
         self.mem = bytearray(0x10_000)
+        # The block compiled for the instruction at each address, the starts
+        # of the blocks compiled from each opcode, and how often each not
+        # yet compiled instruction ran
+        self.code = UNDECODED.copy()
+        self.blocks = {}
+        self.heat = bytearray(0x10_000)
         self.dev = bytearray(0x100)
-        self.ws = FixedSizeStack(0x100)
-        self.rs = FixedSizeStack(0x100)
-
-def spop(s: FixedSizeStack):
-    r = struct.unpack_from("@b", s, len(s) - 1)[0]
-    s.pop()
-    return r
-
-def speek(s: FixedSizeStack, offset: int):
-    r = struct.unpack_from("@b", s, offset)[0]
-    return r
+        self.ws = bytearray(0x100)
+        self.rs = bytearray(0x100)
+        self.reset()
 
-def ushort_peek(ba: bytearray, offset: int) -> int:
-    return struct.unpack_from(">H", ba, offset)[0]
-
-def sshort_peek(ba: bytearray, offset: int) -> int:
-    return struct.unpack_from(">h", ba, offset)[0]
-
-def ushort_pop(s: FixedSizeStack) -> int:
-    r = ushort_peek(s, len(s)-2)
-    s.pop()
-    s.pop()
-    return r
-
-def sshort_pop(s: FixedSizeStack) -> int:
-    r = sshort_peek(s, len(s)-2)
-    s.pop()
-    s.pop()
-    return r
+    def reset(self) -> None:
+        # Reuse the buffers, e.g. when running several ROMs in one process
+        self.pc = 0
+        self.mem[:] = BLANK_MEMORY
+        self.code[:] = UNDECODED
+        self.blocks.clear()
+        self.heat[:] = BLANK_MEMORY
+        self.dev[:] = BLANK_DEVICE
+        self.wsp = 0
+        self.rsp = 0
 
 # System Device
  
@@ -83,520 +72,642 @@ ConsoleArg = 2
 ConsoleArgSpacer = 3
 ConsoleArgEnd = 4
 
-def console_device(port: int, value: int):
-    if port == CONSOLE_WRITE_PORT:
-        sys.stdout.write(chr(value))
-    else:
-        raise ValueError(f"Unknown console port: {port}")
-
-
-# Ops
-def op_imm(u: Uxn, mode2, moder, modek):
-    match (mode2, moder, modek):
-        case (0,0,0):
-            return 1
-        case (1,0,0):
-            op_jci(u)
-        case (0,1,0):
-            op_jmi(u)
-        case (1,1,0):
-            op_jsi(u)
-        case (mode2,moder,1): 
-            op_lit(u, mode2, moder, modek)
-
-def op_jci(u: Uxn):
-    if u.ws.pop():
-        u.pc += sshort_peek(u.mem, u.pc)
-    u.pc += 2
-
-def op_jmi(u: Uxn):
-    u.pc += sshort_peek(u.mem,u.pc) + 2
-
-def op_jsi(u: Uxn):
-    offset_ptr = u.pc
-    u.pc += 2
-    u.rs.push((u.pc&0xff00) >> 8)
-    u.rs.push(u.pc & 0xff)
-    offset = sshort_peek(u.mem, offset_ptr)
-    u.pc += offset
-
-def op_lit(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    pc = u.pc+1+mode2
-    lit = u.mem[u.pc:pc]
-    s.extend(lit)
-    u.pc = pc
-
-
-def op_inc(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if mode2:
-        x = (ushort_pop(s) + 1) & 0xffff
-        s.push(x >> 8)
-        s.push(x & 0xff)
-    else:
-        s.push((s.pop() + 1) & 0xff)
-
+# Console output is batched and written straight to the stdout fd
+console_buffer = bytearray()
+CONSOLE_FLUSH_SIZE = 0x1000
 
-def op_pop(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    s.pop()
-    if mode2:
-        s.pop()
+def console_flush():
+    while console_buffer:
+        del console_buffer[:os.write(1, console_buffer)]
 
+atexit.register(console_flush)
 
-def op_nip(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-    if not modek:
-        s.pop()
-        if mode2:
-            s.pop()
-    if mode2:
-        s.push(top>>8)
-    s.push(top&0xff)
-
-
-def op_swp(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    if mode2:
-        s.push(top>>8)
-    s.push(top&0xff)
-    if mode2:
-        s.push(bot>>8)
-    s.push(bot&0xff)
-
-
-def op_rot(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        mid = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-        bot = ushort_peek(s, len(s)-6) if mode2 else s[-3]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        mid = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    if mode2:
-        s.push(mid>>8)
-    s.push(mid&0xff)
-    if mode2:
-        s.push(top>>8)
-    s.push(top&0xff)
-    if mode2:
-        s.push(bot>>8)
-    s.push(bot&0xff)
-
-
-def op_dup(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-    if mode2:
-        s.push(top>>8)
-    s.push(top&0xff)
-    if mode2:
-        s.push(top>>8)
-    s.push(top&0xff)
-
-def op_ovr(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    if mode2:
-        s.push(bot>>8)
-    s.push(bot&0xff)
-    if mode2:
-        s.push(top>>8)
-    s.push(top&0xff)
-    if mode2:
-        s.push(bot>>8)
-    s.push(bot&0xff)
-
-
-def op_equ(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    s.push(int(bot == top))
-
-
-def op_neq(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
+def console_device(port: int, value: int):
+    if port == CONSOLE_WRITE_PORT:
+        console_buffer.append(value)
+        if value == 0x0a or len(console_buffer) >= CONSOLE_FLUSH_SIZE:
+            console_flush()
     else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    s.push(int(bot != top))
-
+        raise ValueError(f"Unknown console port: {port}")
 
-def op_gth(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        if mode2:
-            res = ushort_peek(s, len(s)-2) < ushort_peek(s,len(s)-4)
-        else:
-            res = s[-1] < s[-2]
-    else:
-        if mode2:
-            res = ushort_pop(s) < ushort_pop(s)
-        else:
-            res = s.pop() < s.pop()
-    s.push(int(res))
+def device_input(u: Uxn, device_port: int) -> int:
+    return u.dev[device_port]
+
+def unknown_device(port: int, value: int):
+    raise NotImplementedError
+
+# Output handlers, indexed by the high nibble of the device port
+DEVICES = [unknown_device] * 0x10
+DEVICES[SYSTEM_DEVICE >> 4] = system_device
+DEVICES[CONSOLE_DEVICE >> 4] = console_device
+
+def device_output(device_port: int, value: int):
+    DEVICES[device_port >> 4](device_port & 0xf, value)
+
+
+# (right, left) shift counts packed into a SFT operand byte
+SFT_SHIFTS = [(b & 0x0f, b >> 4) for b in range(0x100)]
+# Relative addresses are given as a signed byte
+SIGNED_BYTE = [(b ^ 0x80) - 0x80 for b in range(0x100)]
+# Op code and mode flags of every opcode byte
+OP_CODE = bytes(b & 0x1f for b in range(0x100))
+MODE2 = bytes(b >> 5 & 1 for b in range(0x100))
+MODER = bytes(b >> 6 & 1 for b in range(0x100))
+MODEK = bytes(b >> 7 for b in range(0x100))
+
+# Specialized ops
+#
+# Every op is described by its stack effect, uxntal style: the inputs are
+# read off the stack (popped, or peeked in keep mode), the body runs, and the
+# outputs are pushed back. Names follow the width of the op unless suffixed:
+#   a^  always a byte
+#   a*  always a short
+#   a~  an address relative to the pc, given as a signed byte
+#   a@  an absolute short in short mode, a relative byte otherwise
+#   >a  (outputs only) pushed on the other stack
+# A body may be a pair of (byte mode, short mode) sources. It can use `u`,
+# `mem` for the memory and `pc` for the address right after the opcode, jumps
+# by assigning `jump` and halts by returning -1. It can give a short output
+# `a` as its two bytes `a0` and `a1`.
+
+OP_SPECS = {
+    0x01: ("inc", "a", "b = a + 1", "b"),
+    0x02: ("pop", "a", "", ""),
+    0x03: ("nip", "a b", "", "b"),
+    0x04: ("swp", "a b", "", "b a"),
+    0x05: ("rot", "a b c", "", "b c a"),
+    0x06: ("dup", "a", "", "a a"),
+    0x07: ("ovr", "a b", "", "a b a"),
+    0x08: ("equ", "a b", "c = a == b", "c^"),
+    0x09: ("neq", "a b", "c = a != b", "c^"),
+    0x0A: ("gth", "a b", "c = a > b", "c^"),
+    0x0B: ("lth", "a b", "c = a < b", "c^"),
+    0x0C: ("jmp", "a@", "jump = a", ""),
+    0x0D: ("jcn", "c^ a@", "if c:\n    jump = a", ""),
+    0x0E: ("jsr", "a@", "r = pc\njump = a", ">r*"),
+    0x0F: ("sth", "a", "", ">a"),
+    0x10: ("ldz", "a^", (
+        "b = mem[a]",
+        "b0 = mem[a]\nb1 = mem[a + 1]",
+    ), "b"),
+    0x11: ("stz", "v a^", (
+        "mem[a] = v",
+        "mem[a] = v >> 8\nmem[a + 1] = v & 0xff",
+    ), ""),
+    0x12: ("ldr", "a~", (
+        "b = mem[a]",
+        "b0 = mem[a]\nb1 = mem[(a + 1) & 0xffff]",
+    ), "b"),
+    0x13: ("str", "v a~", (
+        "mem[a] = v",
+        "mem[a] = v >> 8\nmem[(a + 1) & 0xffff] = v & 0xff",
+    ), ""),
+    0x14: ("lda", "a*", (
+        "b = mem[a]",
+        "b0 = mem[a]\nb1 = mem[(a + 1) & 0xffff]",
+    ), "b"),
+    0x15: ("sta", "v a*", (
+        "mem[a] = v",
+        "mem[a] = v >> 8\nmem[(a + 1) & 0xffff] = v & 0xff",
+    ), ""),
+    0x16: ("dei", "p^", (
+        "v = device_input(u, p)",
+        "v = device_input(u, p) << 8 | device_input(u, (p + 1) & 0xff)",
+    ), "v"),
+    0x17: ("deo", "v p^", (
+        "DEVICES[p >> 4](p & 0xf, v)",
+        "device_output(p, v >> 8)\ndevice_output((p + 1) & 0xff, v & 0xff)",
+    ), ""),
+    0x18: ("add", "a b", "c = a + b", "c"),
+    0x19: ("sub", "a b", "c = a - b", "c"),
+    0x1A: ("mul", "a b", "c = a * b", "c"),
+    0x1B: ("div", "a b", "c = a // b if b else 0", "c"),
+    0x1C: ("and", "a b", "c = a & b", "c"),
+    0x1D: ("ora", "a b", "c = a | b", "c"),
+    0x1E: ("eor", "a b", "c = a ^ b", "c"),
+    0x1F: ("sft", "a b^", "r, l = SFT_SHIFTS[b]\nc = a >> r << l", "c"),
+}
 
+# The immediate row has no modes, its mode bits pick the op. The jumps read a
+# short offset after the opcode, they wrap at 64KiB so it needs no sign
+# extension.
+IMMEDIATE_SPECS = {
+    0x00: ("brk", "", "return -1", ""),
+    0x20: ("jci", "c^", (
+        "if c:\n"
+        "    jump = (pc + 2 + (mem[pc] << 8 | mem[(pc + 1) & 0xffff])) & 0xffff"
+    ), ""),
+    0x40: ("jmi", "", (
+        "jump = (pc + 2 + (mem[pc] << 8 | mem[(pc + 1) & 0xffff])) & 0xffff"
+    ), ""),
+    0x60: ("jsi", "", (
+        "r = (pc + 2) & 0xffff\n"
+        "jump = (pc + 2 + (mem[pc] << 8 | mem[(pc + 1) & 0xffff])) & 0xffff"
+    ), ">r*"),
+}
 
-def op_lth(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        if mode2:
-            res = ushort_peek(s, len(s)-2) > ushort_peek(s,len(s)-4)
+# LIT is BRK's keep variant, it pushes the operand that follows the opcode
+LIT_SPEC = ("lit", "", (
+    "a = mem[pc]",
+    "a0 = mem[pc]\na1 = mem[(pc + 1) & 0xffff]",
+), "a")
+
+def _operand_kind(name: str, mode2) -> str:
+    kind = name[-1] if name[-1] in "^*~@" else ("*" if mode2 else "^")
+    if kind == "@":
+        kind = "*" if mode2 else "~"
+    return kind
+
+def _index(base: str, offset: int) -> str:
+    if offset > 0:
+        return f"{base} + {offset}"
+    if offset < 0:
+        return f"{base} - {-offset}"
+    return base
+
+def _atomic(expr: str) -> bool:
+    # A name, optionally followed by one subscript or call
+    rest = re.sub(r"^[\w.]+", "", expr)
+    depth = 0
+    for i, char in enumerate(rest):
+        depth += (char in "([") - (char in ")]")
+        if depth == 0 and i < len(rest) - 1:
+            return False
+    return not rest or rest[0] in "(["
+
+def _gen_lines(spec, mode2, moder, modek, lit=0):
+    """Return the lines of one op with its mode flags folded away, the
+    amounts it moves the stack pointers by, left to the caller to apply, how
+    many bytes of each stack it takes as inputs, and how many it needs free
+    on top for a fused literal.
+
+    Stack traffic is inlined: the stacks and their pointers are the locals
+    `ws`, `wsp`, `rs` and `rsp`. Inputs are read at fixed offsets below the
+    stack pointer, outputs written over them (or above them in keep mode).
+
+    With `lit` set to 1 or 2, the op is fused with a LIT of that width right
+    before it: its top input is read from the literal rather than the stack.
+    """
+    op_name, ins, body, outs = spec
+    if isinstance(body, tuple):
+        body = body[mode2]
+    inputs = ins.split()
+    outputs = [o for o in outs.split() if o[0] != ">"]
+    passed = [o[1:] for o in outs.split() if o[0] == ">"]
+    in_names = {name.rstrip("^*~@") for name in inputs}
+    body_names = set(re.findall(r"[A-Za-z_]\w*", body))
+    own, other = ("rs", "ws") if moder else ("ws", "rs")
+    sp = f"{own}p"
+    head = []
+
+    if lit:
+        # The literal sits right before the op's opcode
+        top = inputs.pop()
+        if _operand_kind(top, mode2) == "~":
+            read = "(pc + SIGNED_BYTE[mem[pc - 2]]) & 0xffff"
+        elif lit == 2:
+            read = "mem[pc - 3] << 8 | mem[pc - 2]"
         else:
-            res = s[-1] > s[-2]
-    else:
-        if mode2:
-            res = ushort_pop(s) > ushort_pop(s)
+            read = "mem[pc - 2]"
+        head.append(f"{top.rstrip('^*~@')} = {read}")
+
+    # Shorts only moved around the stack are kept as their two bytes, and
+    # bytes loaded straight from memory need no masking
+    split = {
+        var for var in (name.strip(">^*~@") for name in outs.split())
+        if f"{var}0" in body_names and var not in body_names
+    }
+    loaded = set(re.findall(r"^(\w+) = mem\[[^\]]*\]$", body, re.M))
+    offsets = {}
+    reads = []
+    depth = 0
+    for name in reversed(inputs):
+        kind = _operand_kind(name, mode2)
+        var = name.rstrip("^*~@")
+        depth += 2 if kind == "*" else 1
+        offsets[var] = -depth
+        if kind == "*" and var not in body_names:
+            split.add(var)
+            reads.append((f"{var}0", f"{own}[{_index(sp, -depth)}]"))
+            reads.append((f"{var}1", f"{own}[{_index(sp, 1 - depth)}]"))
+        elif kind == "*":
+            reads.append((var, f"{own}[{_index(sp, -depth)}] << 8 | {own}[{_index(sp, 1 - depth)}]"))
+        elif kind == "~":
+            reads.append((var, f"(pc + SIGNED_BYTE[{own}[{_index(sp, -depth)}]]) & 0xffff"))
         else:
-            res = s.pop() > s.pop()
-
-    s.push(int(res))
-
-
-def op_jmp(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if mode2:
-        u.pc = s.pop() + (s.pop() << 8)
-    else:
-        (top,) = struct.unpack_from("@b", s, len(s) - 1)
-        s.pop()
-        u.pc += top
-
-
-def op_jcn(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        addr = ushort_peek(s, len(s)-2) if mode2 else u.pc+speek(s,len(s)-1)
-        cond  = s[-3] if mode2 else s[-2]
-    else:
-        addr = ushort_pop(s) if mode2 else u.pc+spop(s)
-        cond = s.pop()
-    if cond:
-        u.pc = addr
-
-
-def op_jsr(u: Uxn, mode2, moder, modek):
-    s1,s2 = (u.rs, u.ws) if moder else ( u.ws, u.rs)
-    s2.extend((u.pc >> 8, u.pc & 255))
-    if modek:
-        addr = ushort_peek(s1) if mode2 else u.pc + speek(s1)
-    else:
-        addr = ushort_pop(s1) if mode2 else u.pc + spop(s1)
-    u.pc = addr
-
-
-def op_sth(u: Uxn, mode2, moder, modek):
-    s1,s2 = (u.rs, u.ws) if moder else ( u.ws, u.rs)
-    if modek:
-        val = ushort_peek(s1, len(s1)-2) if mode2 else s1[-1]
-    else:
-        val = ushort_pop(s1) if mode2 else s1.pop()
-
-    if mode2:
-        s2.push((val&0xff00)>>8)
-    s2.push(val&0xff)
-
-def op_ldz(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws 
-    addr = s[-1] if modek else s.pop()
-    s.push(u.mem[addr])
-    if mode2:
-        s.push(u.mem[addr + 1])
-
-def op_stz(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws 
-    if modek:
-        addr = s[-1]
-        val = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        addr = s.pop()
-        val = ushort_pop(s) if mode2 else s.pop()
-    
-    u.mem[addr + mode2] = val & 0xff
-    if mode2:
-        u.mem[addr] = (val>>8) & 0xff
-
-def op_ldr(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws 
-    off = speek(s,len(s)-1) if modek else spop(s)
-    s.push(u.mem[u.pc+off])
-    if mode2:
-        s.push(u.mem[u.pc+off + 1])
-
-def op_str(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws 
-    if modek:
-        off = speek(s,len(s)-1) 
-        val = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        off = spop(s)
-        val = ushort_pop(s) if mode2 else s.pop()
-    
-    u.mem[u.pc + off + mode2] = val & 0xff
-    if mode2:
-        u.mem[u.pc + off] = (val>>8) & 0xff
-
-def op_lda(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws 
-    if modek:
-        addr = s[-1] + (s[-2] << 8)
-    else:
-        addr = s.pop() + (s.pop() << 8)
-    s.push(u.mem[addr])
-    if mode2:
-        s.push(u.mem[addr + 1])
-    
-
-def op_sta(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    addr = ushort_pop(s)
-    u.mem[addr + mode2] = s.pop()
-    if mode2:
-        u.mem[addr] = s.pop()
-
-def op_deo(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    device_port = s.pop()
-    device = device_port & 0xf0
-    port = device_port & 0xf
-    if device == SYSTEM_DEVICE:
-        system_device(port, s.pop())
-    elif device == CONSOLE_DEVICE:
-        console_device(port, s.pop())
-    else:
-        raise NotImplementedError
-
-def op_add(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    sum = top+bot & 0xffff
-    if mode2:
-        s.push(sum >> 8)
-    s.push(sum & 0xff)
-
-
-def op_sub(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    diff = bot-top & 0xffff
-    if mode2:
-        s.push(diff >> 8)
-    s.push(diff & 0xff)
-
-def op_mul(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    diff = bot*top & 0xffff
-    if mode2:
-        s.push(diff >> 8)
-    s.push(diff & 0xff)
-
-def op_div(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    quo = (bot//top) & 0xffff if top else 0
-    if mode2:
-        s.push(quo >> 8)
-    s.push(quo & 0xff)
-
-def op_and(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    res = (bot&top)
-    if mode2:
-        s.push(res >> 8)
-    s.push(res & 0xff)
-
-def op_ora(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
-    else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    res = (bot|top)
-    if mode2:
-        s.push(res >> 8)
-    s.push(res & 0xff)
-
-def op_eor(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = ushort_peek(s, len(s)-2) if mode2 else s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
+            reads.append((var, f"{own}[{_index(sp, -depth)}]"))
+    tail = body.splitlines()
+
+    def push(names, stack, at):
+        for name in names:
+            kind = _operand_kind(name, mode2)
+            var = name.rstrip("^*~@")
+            if stack == own and offsets.get(var) == at:
+                pass
+            elif var in split:
+                tail.append(f"{stack}[{_index(stack + 'p', at)}] = {var}0")
+                tail.append(f"{stack}[{_index(stack + 'p', at + 1)}] = {var}1")
+            elif kind == "*":
+                high = f"{var} >> 8" if var in in_names else f"{var} >> 8 & 0xff"
+                tail.append(f"{stack}[{_index(stack + 'p', at)}] = {high}")
+                tail.append(f"{stack}[{_index(stack + 'p', at + 1)}] = {var} & 0xff")
+            else:
+                low = var if var in in_names or var in loaded else f"{var} & 0xff"
+                tail.append(f"{stack}[{_index(stack + 'p', at)}] = {low}")
+            at += 2 if kind == "*" else 1
+        return at
+
+    base = 0 if modek else -depth
+    moves = {own: push(outputs, own, base)}
+    if passed:
+        moves[other] = push(passed, other, 0)
+
+    # A store to an opcode that went into a compiled block drops the block
+    stores = re.findall(r"^mem\[(.+)\] = ", body, re.M)
+    if stores:
+        tail[len(body.splitlines()):0] = [
+            f"if {' or '.join(f'{at} in u.blocks' for at in stores)}:",
+            *(f"    forget(u, {at})" for at in stores),
+        ]
+
+    # A one line body reads the inputs it alone uses in place, and a byte it
+    # computes goes straight into its write if no other write comes first
+    if body and "\n" not in body:
+        for var, read in reads[:]:
+            word = rf"\b{var}\b"
+            if re.search(word, tail[0]) and len(re.findall(word, "\n".join(tail))) == 1:
+                reads.remove((var, read))
+                if not (_atomic(read) or tail[0].endswith(f" = {var}") or f"[{var}]" in tail[0]):
+                    read = f"({read})"
+                tail[0] = re.sub(word, read, tail[0])
+        result = re.fullmatch(r"(\w+) = (.+)", tail[0])
+        if result:
+            word = rf"\b{result[1]}\b"
+            uses = [i for i, line in enumerate(tail) if re.search(word, line)]
+            if (
+                len(uses) == 2
+                and re.fullmatch(rf"[wr]s\[[^]]*\] = {result[1]}( & 0xff)?", tail[uses[1]])
+                and not any(re.match(r"[wr]s\[", line) for line in tail[1:uses[1]])
+            ):
+                value = result[2] if _atomic(result[2]) else f"({result[2]})"
+                tail[uses[1]] = re.sub(word, value, tail[uses[1]])
+                del tail[0]
+
+    # Inputs left in place, or dropped, are never read
+    used = set(re.findall(r"[A-Za-z_]\w*", "\n".join(tail)))
+    head.extend(f"{var} = {read}" for var, read in reads if var in used)
+    return head + tail, moves, {own: depth}, {own: lit}
+
+def _fn_name(spec, mode2, moder, modek, lit=0) -> str:
+    name = f"op_{spec[0]}{'2' if mode2 else ''}{'k' if modek else ''}{'r' if moder else ''}"
+    if lit:
+        name = f"op_lit{'2' if lit == 2 else ''}{'r' if moder else ''}_{name[3:]}"
+    return name
+
+def _prologue(lines) -> list:
+    # Load the stacks and pointers the lines use into locals
+    text = "\n".join(lines)
+    loads = []
+    for stack in ("ws", "rs"):
+        if re.search(rf"(?<![\w.]){stack}\[", text):
+            loads.append(f"{stack} = u.{stack}")
+        if re.search(rf"(?<![\w.]){stack}p\b", text):
+            loads.append(f"{stack}p = u.{stack}p")
+    return loads
+
+def _underflow(depths):
+    # The test for stacks too shallow to take the inputs, if there are any.
+    # Stack pointers are never let go below 0, so a negative index never
+    # wraps around to the top of a stack
+    return " or ".join(f"{stack}p < {n}" for stack, n in depths.items() if n > 0) or None
+
+def _overflow(rooms):
+    # The test for a fused literal that would not fit on its stack, where the
+    # LIT on its own fails to push it
+    return " or ".join(f"{stack}p > {0x100 - n}" for stack, n in rooms.items() if n > 0) or None
+
+def _gen_op(spec, mode2, moder, modek, lit=0, operand=0) -> str:
+    """Return the source of the handler for one op, see _gen_lines. It is
+    called with the address right after the opcode and returns the address
+    of the next one.
+
+    `operand` is the size of the immediate that follows the opcode.
+    """
+    lines, moves, depths, rooms = _gen_lines(spec, mode2, moder, modek, lit)
+    lines += [f"u.{stack}p = {stack}p + {n}" for stack, n in moves.items() if n > 0]
+    lines += [f"u.{stack}p = {stack}p - {-n}" for stack, n in moves.items() if n < 0]
+    following = f"(pc + {operand}) & 0xffff" if operand else "pc"
+    if any(line.startswith("jump = ") for line in lines):
+        lines.append("return jump")
+    elif any("jump = " in line for line in lines):
+        lines[:0] = [f"jump = {following}"]
+        lines.append("return jump")
+    elif "return -1" not in lines:
+        lines.append(f"return {following}")
+    if lit:
+        lines[:0] = [f"pc = (pc + {lit + 1}) & 0xffff"]
+    underflow = _underflow(depths)
+    if underflow:
+        lines[:0] = [f"if {underflow}:", '    raise IndexError("stack underflow")']
+    overflow = _overflow(rooms)
+    if overflow:
+        lines[:0] = [f"if {overflow}:", '    raise IndexError("stack overflow")']
+    lines[:0] = _prologue(lines)
+    body = "\n".join(f"    {line}" for line in lines)
+    return f"def {_fn_name(spec, mode2, moder, modek, lit)}(u, mem, pc):\n{body}\n"
+
+def _decode(mem, pc):
+    """Return the spec, mode flags, fused literal width and size of the
+    instruction at `pc`, fusing a LIT with the op after it when possible."""
+    op_mode_code = mem[pc]
+    op_code = OP_CODE[op_mode_code]
+    mode2, moder, modek = MODE2[op_mode_code], MODER[op_mode_code], MODEK[op_mode_code]
+    if op_code:
+        return OP_SPECS[op_code], mode2, moder, modek, 0, 1
+    if not modek:
+        return IMMEDIATE_SPECS[op_mode_code], 0, 0, 0, 0, 3 if op_mode_code else 1
+    following = mem[(pc + 2 + mode2) & 0xffff]
+    if LIT_FUSED[(op_mode_code >> 5 & 3) << 8 | following]:
+        return OP_SPECS[OP_CODE[following]], MODE2[following], moder, 0, 1 + mode2, 3 + mode2
+    return LIT_SPEC, mode2, moder, 0, 0, 2 + mode2
+
+# Longest run of instructions compiled into one block
+BLOCK_SIZE = 32
+
+def _fold(line: str) -> str:
+    # With the pc a constant, work out the addresses next to it, e.g. the
+    # operand reads `mem[0x0123 - 3] << 8 | mem[0x0123 - 2]`
+    def add(match):
+        at = int(match[2], 16) + (int(match[4]) if match[3] == "+" else -int(match[4]))
+        return f"{match[1]}0x{at:04x}" if 0 <= at <= 0xffff else match[0]
+
+    line = re.sub(r"([(\[]|= )(0x[0-9a-f]{4}) ([+-]) (\d+)\b(?! *[*/%])", add, line)
+    return re.sub(r"\((0x[0-9a-f]{4})\) & 0xffff", r"\1", line)
+
+def _gen_block(mem, start):
+    """Return the source of a function running the straight-line code from
+    `start` up to and including its first jump, the addresses of the
+    opcodes it was compiled from, and for each line of the source the op it
+    belongs to.
+
+    Each op is inlined with its pc as a constant. The stack pointers stay in
+    locals that are only moved when the block jumps back to `start`: every
+    op indexes the stacks at offsets counted from where they were loaded, and
+    the pointers are stored back once when leaving the block. The op of a
+    line is given as its address and these offsets, for _locate_error.
+    """
+    lines = []
+    opcodes = []
+    # How far each stack pointer has moved from its local, how deep the
+    # stacks must be for the ops so far, and how much room their literals need
+    moved = {"ws": 0, "rs": 0}
+    needed = {"ws": 0, "rs": 0}
+    room = {"ws": 0, "rs": 0}
+
+    def shift(match):
+        return _index(f"{match[1]}p", moved[match[1]] + int((match[2] or "0").replace(" ", "")))
+
+    def store():
+        # Filled in once the block is done, see below
+        return [f"STORE {moved['ws']} {moved['rs']}"]
+
+    pc = start
+    for _ in range(BLOCK_SIZE):
+        spec, mode2, moder, modek, lit, size = _decode(mem, pc)
+        opcodes.append(pc)
+        if lit:
+            opcodes.append((pc + lit + 1) & 0xffff)
+        op_lines, moves, depths, rooms = _gen_lines(spec, mode2, moder, modek, lit)
+        for stack, n in depths.items():
+            needed[stack] = max(needed[stack], n - moved[stack])
+        for stack, n in rooms.items():
+            if n:
+                room[stack] = max(room[stack], n + moved[stack])
+        # Ops are compiled against the address after their (last) opcode
+        here = f"0x{(pc + 1 + (lit + 1 if lit else 0)) & 0xffff:04x}"
+        op_lines = [_fold(re.sub(r"(?<![\w.])pc\b", here, line)) for line in op_lines]
+        op_lines = [re.sub(r"\b([wr]s)p\b( [+-] \d+)?", shift, line) for line in op_lines]
+        op_lines[:0] = [f"OP {pc} {moved['ws']} {moved['rs']}"]
+        for stack, n in moves.items():
+            moved[stack] += n
+        pc = (pc + size) & 0xffff
+        jumps = any("jump = " in line for line in op_lines)
+        # A store may have changed an opcode further down this block
+        for i, line in reversed(list(enumerate(op_lines))):
+            if line.startswith("    forget("):
+                op_lines[i + 1:i + 1] = [f"    {line}" for line in store() + [f"return 0x{pc:04x}"]]
+                break
+        if "return -1" in op_lines:
+            lines += store() + ["return -1"]
+            break
+        if jumps:
+            # A jump back to the start runs the block again in place
+            lines += [f"jump = 0x{pc:04x}", *op_lines]
+            lines += [f"{stack}p += {n}" if n > 0 else f"{stack}p -= {-n}" for stack, n in moved.items() if n]
+            lines += [f"if jump != 0x{start:04x}:", "    STORE 0 0", "    return jump"]
+            lines[:] = ["while True:", *(f"    {line}" for line in lines)]
+            break
+        lines += op_lines
     else:
-        top = ushort_pop(s) if mode2 else s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    res = (bot^top)
-    if mode2:
-        s.push(res >> 8)
-    s.push(res & 0xff)
-
-def op_sft(u: Uxn, mode2, moder, modek):
-    s = u.rs if moder else u.ws
-    if modek:
-        top = s[-1]
-        bot = ushort_peek(s, len(s)-4) if mode2 else s[-2]
+        lines += store() + [f"return 0x{pc:04x}"]
+
+    # On a stack too shallow for any op in the block, or too full for any of
+    # its literals, it runs one op at a time for the op that fails to raise.
+    # A loop checks on every pass
+    looping = lines[0] == "while True:"
+    unfit = " or ".join(filter(None, (_underflow(needed), _overflow(room))))
+    if unfit:
+        lines[looping:looping] = [
+            f"{'    ' * looping}{line}" for line in [
+                f"if {unfit}:",
+                "    STORE 0 0",
+                f"    return HANDLERS[mem[0x{start:04x}]](u, mem, 0x{(start + 1) & 0xffff:04x})",
+            ]
+        ]
+
+    # Every exit stores back the pointers it moved. A block that loops moves
+    # its locals on each pass, so there an exit stores every pointer the loop
+    # moves, even one the exit itself has not moved yet
+
+    def expand(line):
+        match = re.fullmatch(r"( *)STORE (-?\d+) (-?\d+)", line)
+        if not match:
+            return [line]
+        at = {"ws": int(match[2]), "rs": int(match[3])}
+        return [
+            f"{match[1]}u.{stack}p = {_index(stack + 'p', at[stack])}"
+            for stack in ("ws", "rs") if at[stack] or looping and moved[stack]
+        ]
+
+    lines = [store for line in lines for store in expand(line)]
+    lines[:0] = _prologue(lines)
+
+    # Each op is headed by an OP placeholder, taken out here into the table
+    # of source lines, which count from the def
+    body = []
+    ops = {}
+    op = (start, 0, 0)
+    for line in lines:
+        match = re.fullmatch(r" *OP (\d+) (-?\d+) (-?\d+)", line)
+        if match:
+            op = tuple(map(int, match.groups()))
+            continue
+        body.append(f"    {line}")
+        ops[len(body) + 1] = op
+    body = "\n".join(body)
+    return f"def block_{start:04x}(u, mem, pc):\n{body}\n", opcodes, ops
+
+def _gen_handlers():
+    namespace = {}
+
+    def build(spec, mode2, moder, modek, lit=0, operand=0):
+        src = _gen_op(spec, mode2, moder, modek, lit, operand)
+        exec(compile(src, f"<op_{spec[0]}>", "exec"), globals(), namespace)
+        return namespace.popitem()[1]
+
+    for op_code, spec in IMMEDIATE_SPECS.items():
+        HANDLERS[op_code] = build(spec, 0, 0, 0, operand=2 if op_code else 0)
+    for op_code, spec in OP_SPECS.items():
+        for mode in range(8):
+            HANDLERS[op_code | mode << 5] = build(spec, mode & 1, mode >> 1 & 1, mode >> 2)
+
+    # A LIT followed by an op on the same stack whose top input has the
+    # literal's width runs as one fused handler, found through LIT_FUSED
+    for mode in range(4):
+        lit2, litr = mode & 1, mode >> 1
+        HANDLERS[0x80 | mode << 5] = build(LIT_SPEC, lit2, litr, 0, operand=1 + lit2)
+        for op_code, spec in OP_SPECS.items():
+            for mode2 in (0, 1):
+                if (_operand_kind(spec[1].split()[-1], mode2) == "*") == lit2:
+                    LIT_FUSED[mode << 8 | litr << 6 | mode2 << 5 | op_code] = (
+                        build(spec, mode2, litr, 0, lit=1 + lit2)
+                    )
+
+# Every opcode byte resolves to a handler already bound to its mode flags
+HANDLERS = [None] * 0x100
+LIT_FUSED = [None] * 0x400
+_gen_handlers()
+
+def _op_name(op_mode_code) -> str:
+    op_code = OP_CODE[op_mode_code]
+    mode2, moder, modek = MODE2[op_mode_code], MODER[op_mode_code], MODEK[op_mode_code]
+    if op_code:
+        name = OP_SPECS[op_code][0]
+    elif modek:
+        name, modek = LIT_SPEC[0], 0
     else:
-        top = s.pop()
-        bot = ushort_pop(s) if mode2 else s.pop()
-    res = (bot >> (top&0xf)) << ((top&0xf0)>>4)
-    if mode2:
-        s.push((res >> 8) & 0xff)
-    s.push(res & 0xff)
-
-OPS = {
-    0x00: op_imm,
-    0x01: op_inc,
-    0x02: op_pop,
-    0x03: op_nip,
-    0x04: op_swp,
-    0x05: op_rot,
-    0x06: op_dup,
-    0x07: op_ovr,
-    0x08: op_equ,
-    0x09: op_neq,
-    0x0A: op_gth,
-    0x0B: op_lth,
-    0x0C: op_jmp,
-    0x0D: op_jcn,
-    0x0E: op_jsr,
-    0x0F: op_sth,
-    0x10: op_ldz,
-    0x11: op_stz,
-    0x12: op_ldr,
-    0x13: op_str,
-    0x14: op_lda,
-    0x15: op_sta,
-    0x17: op_deo,
-    0x18: op_add,
-    0x19: op_sub,
-    0x1A: op_mul,
-    0x1B: op_div,
-    0x1C: op_and,
-    0x1D: op_ora,
-    0x1E: op_eor,
-    0x1F: op_sft,
-}
-
-
+        return IMMEDIATE_SPECS[op_mode_code][0].upper()
+    return f"{name.upper()}{'2' if mode2 else ''}{'r' if moder else ''}{'k' if modek else ''}"
+
+# Uxntal name of every opcode byte, for the trace
+OP_NAMES = [_op_name(op_mode_code) for op_mode_code in range(0x100)]
+
+# Runs of an instruction before a block is compiled from it
+HOT = 8
+
+def op_decode(u, mem, pc):
+    # Stands in for an instruction not compiled yet. It runs the instruction
+    # on its own until it gets hot, then compiles the block starting there
+    # and leaves it in u.code
+    start = (pc - 1) & 0xffff
+    heat = u.heat
+    if heat[start] < HOT:
+        heat[start] += 1
+        op_mode_code = mem[start]
+        handler = HANDLERS[op_mode_code]
+        if op_mode_code & 0x9f == 0x80:
+            mode = op_mode_code >> 5
+            handler = LIT_FUSED[(mode & 3) << 8 | mem[(pc + 1 + (mode & 1)) & 0xffff]] or handler
+        return handler(u, mem, pc)
+    src, opcodes, ops = _gen_block(mem, start)
+    namespace = {}
+    exec(compile(src, f"<block_{start:04x}>", "exec"), globals(), namespace)
+    block = u.code[start] = namespace.popitem()[1]
+    block.ops = ops
+    for address in opcodes:
+        u.blocks.setdefault(address, set()).add(start)
+    return block(u, mem, pc)
+
+def forget(u, address):
+    # Sends the blocks compiled from the opcode at `address` back to op_decode
+    for start in u.blocks.pop(address, ()):
+        u.code[start] = op_decode
+        u.heat[start] = 0
+
+UNDECODED = [op_decode] * 0x10_000
 
 def dump_state(u: Uxn):
     return {
         "mem": " ".join(hex(i) for i in u.mem[u.pc-3:u.pc+4]),
         "dev": {"console": " ".join(hex(i) for i in u.dev[0x10:0x20])},
         "pc": hex(u.pc),
-        "ws": u.ws,
-        "rs": u.rs,
+        "ws": format_stack(u.ws, u.wsp),
+        "rs": format_stack(u.rs, u.rsp),
     }
 
 def load_image(u: Uxn, prog: bytes):
     if len(prog) > len(u.mem) - 0x100:
         raise ValueError("Program too large")
-    u.mem[0x100 : len(prog)] = prog
+    u.mem[0x100 : 0x100 + len(prog)] = prog
+    u.code[:] = UNDECODED
+    u.blocks.clear()
+    u.heat[:] = BLANK_MEMORY
 
 def run_vector(u: Uxn, pc):
-    u.pc = pc
-    while True:
-        op_mode_code = u.mem[u.pc]
-        if exec_op(u, op_mode_code): 
-            break
-
-def exec_op(u: Uxn, op_mode_code):
-    op_code = op_mode_code & 0x1f
-    mode2 = op_mode_code >> 5 & 1
-    moder = op_mode_code >> 6 & 1
-    modek = op_mode_code >> 7 & 1
-    op = OPS[op_code]
-    if op_code:
-        op_name = op.__name__[3:]
-    elif modek:
-        op_name = "LIT"
-    elif mode2 and moder:
-        op_name = "JSI"
-    elif moder:
-        op_name = "JMI"
-    elif mode2:
-        op_name = "JCI"
-    elif not (op_code or mode2 or moder or modek):
-        op_name = "BRK"
+    # The pc stays a local, u.pc is only set for the trace and for
+    # dump_state after an error
+    mem = u.mem
+    if logging.root.isEnabledFor(logging.DEBUG):
+        while pc >= 0:
+            u.pc = pc
+            pc = exec_op(u, mem[pc])
     else:
-        raise ValueError("Unreachable")
+        code = u.code
+        try:
+            while pc >= 0:
+                pc = code[pc](u, mem, (pc + 1) & 0xffff)
+        except Exception as e:
+            u.pc = pc
+            _locate_error(u, code[pc], e.__traceback__)
+            raise
+    console_flush()
+
+def _locate_error(u: Uxn, block, tb):
+    # An error inside a compiled block is put down to the op it came from,
+    # going by the block's table of source lines, with the stack pointers
+    # that op saw. The block is the one at the pc the error was raised from,
+    # compiled by op_decode in that same call if need be
+    if block is op_decode:
+        return
+    while tb:
+        frame = tb.tb_frame
+        if frame.f_code is block.__code__:
+            u.pc, *offsets = block.ops[tb.tb_lineno]
+            for stack, n in zip(("ws", "rs"), offsets):
+                if f"{stack}p" in frame.f_locals:
+                    setattr(u, f"{stack}p", frame.f_locals[f"{stack}p"] + n)
+            return
+        tb = tb.tb_next
 
-    logging.debug(f"{u.rs}, {u.ws}")
-    logging.debug(f"#{u.pc:04x}: #{u.mem[u.pc]:02x} {op_name.upper()}{'2' if mode2 else ''}{'r' if moder else ''}{'k' if modek else ''}")
-    u.pc += 1
-    return op(u, mode2, moder, modek)
- 
+def exec_op(u: Uxn, op_mode_code):
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("%s, %s", format_stack(u.rs, u.rsp, 8), format_stack(u.ws, u.wsp, 8))
+        logging.debug("#%04x: #%02x %s", u.pc, op_mode_code, OP_NAMES[op_mode_code])
+    return HANDLERS[op_mode_code](u, u.mem, (u.pc + 1) & 0xffff)
 
 def set_argc(u: Uxn):
     u.dev[0x17] = len(sys.argv) - 1
 
 def forward_args(u: Uxn):
     for i, arg in enumerate(sys.argv):
-        for char in arg:
-            u.dev[0x12] = ord(char)
+        for b in arg.encode():
+            u.dev[0x12] = b
             u.dev[0x17] = ConsoleArg
             run_vector(u, u.mem[1])
-        u.dev[0x12] = ord(char)
+        u.dev[0x12] = b
         isLast = i + 1 == len(sys.argv)
         u.dev[0x17] = ConsoleArgEnd if isLast else ConsoleArgSpacer
-        run_vector(u, ushort_peek(u.dev, ConsoleVectorPtr))
+        run_vector(u, u.dev[ConsoleVectorPtr] << 8 | u.dev[ConsoleVectorPtr + 1])
 
 # Main
 
@@ -616,6 +727,7 @@ def main():
         # forward_args(u)
         run_vector(u, Uxn.RESET)
     except Exception as e:
+        console_flush()
         pprint.pprint(dump_state(u))
         raise e
 